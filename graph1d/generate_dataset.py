@@ -97,7 +97,10 @@ class Dataset(DGLDataset):
         Process Dataset.
 
         This function creates lightgraphs, the index map, and collects all times
-        from the graphs.
+        from the graphs. In the lightgraphs, masks are converted to boolean
+        tensors and the mask weighting the training loss is computed once per
+        graph, since they only depend on the topology. The input graphs are not
+        modified.
 
         """
         start = time.time()
@@ -112,9 +115,25 @@ class Dataset(DGLDataset):
             for ndata in node_data:
                 if 'mask' not in ndata:
                     del lightgraph.ndata[ndata]
+                else:
+                    lightgraph.ndata[ndata] = lightgraph.ndata[ndata].bool()
             for edata in edge_data:
                 del lightgraph.edata[edata]
 
+            lightgraph.ndata['train_mask'] = generate_train_mask(lightgraph)
+            # flowrate gate used in the continuity loss (junction nodes that are
+            # not inlet or outlets)
+            boundary = lightgraph.ndata['inlet_mask'] | \
+                       lightgraph.ndata['outlet_mask']
+            lightgraph.ndata['flow_gate'] = (lightgraph.ndata['jun_mask'] & \
+                                             ~boundary).float()
+
+            # timestep used to scale the noise (see add_noise)
+            dt = nz.invert_normalize(graph.ndata['dt'][0], 'dt',
+                                     self.params['statistics'], 'features')
+            lightgraph.ndata['timestep'] = th.full((graph.num_nodes(), 1),
+                                                   float(dt))
+
             self.times.append(graph.ndata['nfeatures'].shape[2])
             self.lightgraphs.append(lightgraph)
 
@@ -131,7 +150,7 @@ class Dataset(DGLDataset):
         """
         Get ith lightgraph
 
-        Noise is added to node features of the graph (pressure and flowrate).
+        Noise is not added here, but on the batched graphs (see add_noise).
 
         Arguments:
             i: index of the graph
@@ -143,22 +162,9 @@ class Dataset(DGLDataset):
         igraph = indices[0]
         itime = indices[1]
 
-        features = self.graphs[igraph].ndata['nfeatures'].clone()
+        features = self.graphs[igraph].ndata['nfeatures']
 
         nf = features[:,:,itime].clone()
-        nfsize = nf[:,:2].shape
-
-        dt = nz.invert_normalize(self.graphs[igraph].ndata['dt'][0], 'dt',
-                                 self.params['statistics'], 'features')
-
-        curnoise = np.random.normal(0, self.params['rate_noise'] * dt, nfsize)
-        nf[:,:2] = nf[:,:2] + curnoise
-
-        fnoise = np.random.normal(0, self.params['rate_noise_features'],
-                                  nf[:,2:].shape)
-        # flowrate at inlet is exact
-        fnoise[self.graphs[igraph].ndata['inlet_mask'].bool(),1] = 0
-        nf[:,2:] = nf[:,2:] + fnoise
 
         self.lightgraphs[igraph].ndata['nfeatures'] = nf
 
@@ -167,11 +173,6 @@ class Dataset(DGLDataset):
         self.lightgraphs[igraph].ndata['next_steps'] = ns
 
         ef = self.graphs[igraph].edata['efeatures']
-
-        # add regular noise to the edge features to prevent overfitting
-        fnoise = np.random.normal(0, self.params['rate_noise_features'],
-                                  ef[:,2:].shape)
-        ef[:,2:] = ef[:,2:] + fnoise
         self.lightgraphs[igraph].edata['efeatures'] = ef.squeeze()
 
         return self.lightgraphs[igraph]
@@ -209,6 +210,58 @@ class Dataset(DGLDataset):
         print('Total number of graphs: {:}'.format(self.__len__()))
         return 'Dataset = ' + ', '.join(self.graph_names)
 
+def add_noise(graph, params):
+    """
+    Add noise to the features of a (batched) lightgraph.
+
+    Noise is sampled directly on the device of the graph. Pressure and
+    flowrate noise is proportional to the timestep of each graph; the other
+    node features and the edge features get regular noise to prevent
+    overfitting. The graph features are replaced (not modified in place).
+
+    Arguments:
+        graph: DGL graph generated by Dataset
+        params: dictionary of parameters
+
+    """
+    nf = graph.ndata['nfeatures']
+    noise = th.randn_like(nf)
+    noise[:,:2] = noise[:,:2] * params['rate_noise'] * \
+                  graph.ndata['timestep']
+    noise[:,2:] = noise[:,2:] * params['rate_noise_features']
+    # flowrate at inlet is exact
+    noise[graph.ndata['inlet_mask'].bool(),3] = 0
+    graph.ndata['nfeatures'] = nf + noise
+
+    ef = graph.edata['efeatures']
+    noise = th.randn_like(ef) * params['rate_noise_features']
+    noise[:,:2] = 0
+    graph.edata['efeatures'] = ef + noise
+
+def generate_train_mask(graph, bccoeff = 100):
+    """
+    Generate mask used to weight the training loss.
+
+    The loss at boundary nodes is multiplied by bccoeff for the pressure at
+    inlet and outlets and for the flow rate at outlets (flow rate at the inlet
+    is known).
+
+    Arguments:
+        graph: DGL graph
+        bccoeff: weight of the boundary nodes. Default -> 100
+
+    Returns:
+        n x 2 tensor containing the weights for pressure and flow rate
+
+    """
+    inmask = graph.ndata['inlet_mask'].bool()
+    outmask = graph.ndata['outlet_mask'].bool()
+    mask = th.ones((inmask.shape[0], 2))
+    mask[inmask,0] = bccoeff
+    mask[outmask,0] = bccoeff
+    mask[outmask,1] = bccoeff
+    return mask
+
 def split(graphs, divs, dataset_info):
     """
     Split a list of graphs.
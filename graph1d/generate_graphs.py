@@ -25,6 +25,8 @@ import tools.io_utils as io
 import numpy as np
 import scipy
 from scipy import interpolate
+from scipy import sparse
+from scipy.sparse import csgraph
 import dgl
 import torch as th
 from tqdm import tqdm
@@ -33,6 +35,7 @@ import random
 import tools.plot_tools as pt
 import matplotlib.pyplot as plt
 import shutil
+import heapq
 
 def generate_types(bif_id, indices):
     """
@@ -50,28 +53,14 @@ def generate_types(bif_id, indices):
         Outlet maks, i.e., array containing 1 at outlet indices and 0 elsewhere
 
     """
-    types = []
-    inlet_mask = []
-    outlet_mask = []
-    for i, id in enumerate(bif_id):
-        if id == -1:
-            cur_type = 0
-        else:
-            cur_type = 1
-        if i in indices['inlet']:
-            cur_type = 2
-        elif i in indices['outlets']:
-            cur_type = 3
-        types.append(cur_type)
-        if cur_type == 2:
-            inlet_mask.append(True)
-        else:
-            inlet_mask.append(False)
-        if cur_type == 3:
-            outlet_mask.append(True)
-        else:
-            outlet_mask.append(False)
-    types = th.nn.functional.one_hot(th.tensor(types), num_classes = 4)
+    types = np.where(bif_id == -1, 0, 1)
+    # inlet is set last, so it takes precedence over outlets
+    types[np.array(indices['outlets'], dtype = int)] = 3
+    types[np.array(indices['inlet'], dtype = int)] = 2
+    inlet_mask = types == 2
+    outlet_mask = types == 3
+    types = th.nn.functional.one_hot(th.from_numpy(types).long(),
+                                     num_classes = 4)
     return types, inlet_mask, outlet_mask
 
 def generate_edge_features(points, edges1, edges2):
@@ -92,15 +81,11 @@ def generate_edge_features(points, edges1, edges2):
         n dimensional numpy array containing |x_j - x_i|
 
     """
-    rel_position = []
-    rel_position_norm = []
-    nedges = len(edges1)
-    for i in range(nedges):
-        diff = points[edges2[i],:] - points[edges1[i],:]
-        ndiff = np.linalg.norm(diff)
-        rel_position.append(diff / ndiff)
-        rel_position_norm.append(ndiff)
-    return np.array(rel_position), rel_position_norm
+    diff = points[edges2,:] - points[edges1,:]
+    ndiff = np.linalg.norm(diff, axis = 1, keepdims = True)
+    rel_position = diff / ndiff
+    rel_position_norm = ndiff.ravel()
+    return rel_position, rel_position_norm
 
 def add_fields(graph, field, field_name, offset = 0,
                pad = 10):
@@ -125,38 +110,33 @@ def add_fields(graph, field, field_name, offset = 0,
     timesteps.sort()
     dt = (timesteps[1] - timesteps[0])
     T = timesteps[-1]
-    # we use the third dimension for time
-    field_t = th.zeros((list(field.values())[0].shape[0], 1,
-                        len(timesteps) - offset + pad))
-
     times = [t for t in field]
     times.sort()
     times = times[offset:]
 
-    loading_t = th.zeros((list(field.values())[0].shape[0], 1,
-                          len(timesteps) - offset + pad), dtype = th.bool)
+    # all timesteps are converted at once, time is the second dimension
+    values = np.stack([field[t] for t in times], axis = 1)
+    values = th.from_numpy(values.astype(np.float32))
+    nnodes = values.shape[0]
+
+    # we use the third dimension for time
+    field_t = th.zeros((nnodes, 1, len(times) + pad))
+    loading_t = th.zeros((nnodes, 1, len(times) + pad), dtype = th.bool)
 
     if pad > 0:
         # def interpolate_function(count):
         #     return (1 - np.cos(np.pi * count / pad)) / 2
 
-        inc = th.tensor(field[times[0]], dtype = th.float32)
+        inc = values[:,0:1]
         deft = inc * 0
         if field_name == 'pressure':
-
-            minp = np.infty
-            for t in field:
-                minp = np.min((minp, np.min(field[t])))
+            minp = np.min([np.min(field[t]) for t in field])
             deft = deft + minp
-        for i in range(pad):
-            field_t[:,0,i] = deft * (pad - i)/pad + inc * (i / pad)
-            loading_t[:,0,i] = True
-    
-    for i, t in enumerate(times):
-        f = th.tensor(field[t], dtype = th.float32)
-        field_t[:,0,i + pad] = f
-        loading_t[:,0,i + pad] = False
-        # graph.ndata[field_name + '_{}'.format(count - offset)] = f
+        steps = th.arange(pad, dtype = th.float32)
+        field_t[:,0,:pad] = deft * (pad - steps) / pad + inc * (steps / pad)
+        loading_t[:,0,:pad] = True
+
+    field_t[:,0,pad:] = values
 
     graph.ndata[field_name] = field_t
     graph.ndata['loading'] = loading_t
@@ -176,12 +156,35 @@ def find_outlets(edges1, edges2):
         edges2: numpy array containing indices of dest nodes for every edge
 
     """
-    outlets = []
-    for e in edges2:
-        if e not in edges1:
-            outlets.append(e)
+    sources = set(np.asarray(edges1).tolist())
+    outlets = [e for e in np.asarray(edges2).tolist() if e not in sources]
     return outlets
 
+def compose_replacements(idxs_to_delete, idxs_to_replace, npoints):
+    """
+    Compose replacements.
+
+    Generate a lookup table that maps every node index to the index it ends up
+    with when the deleted nodes are replaced one at a time, in order. The
+    replacements are composed backwards so that chains (a node replaced by a
+    node that is deleted later) are resolved.
+
+    Arguments:
+        idxs_to_delete: indices of nodes to delete
+        idxs_to_replace: indices of nodes that replace the deleted nodes.
+                         Must have the same number of components as
+                         idxs_to_delete
+        npoints: total number of nodes in the graph
+
+    Returns:
+        numpy array with npoints components containing the new node indices
+
+    """
+    replace = np.arange(npoints)
+    for i in reversed(range(len(idxs_to_delete))):
+        replace[idxs_to_delete[i]] = replace[idxs_to_replace[i]]
+    return replace
+
 def remove_points(idxs_to_delete, idxs_to_replace, edges1, edges2, npoints):
     """
     Remove points.
@@ -204,25 +207,21 @@ def remove_points(idxs_to_delete, idxs_to_replace, edges1, edges2, npoints):
         (modified) numpy array containing indices of dest nodes for every edge
 
     """
-    npoints_to_delete = len(idxs_to_delete)
-
-    for i in range(npoints_to_delete):
-        i1 = np.where(edges1 == idxs_to_delete[i])[0]
-        if (len(i1)) != 0:
-            edges1[i1] = idxs_to_replace[i]
-
-        i2 = np.where(edges2 == idxs_to_delete[i])[0]
-        if (len(i2)) != 0:
-            edges2[i2] = idxs_to_replace[i]
+    replace = compose_replacements(idxs_to_delete, idxs_to_replace, npoints)
+    edges1 = replace[edges1]
+    edges2 = replace[edges2]
 
-    edges_to_delete = np.where(edges1 == edges2)[0]
-    edges1 = np.delete(edges1, edges_to_delete)
-    edges2 = np.delete(edges2, edges_to_delete)
+    keep = edges1 != edges2
+    edges1 = edges1[keep]
+    edges2 = edges2[keep]
 
     sampled_indices = np.delete(np.arange(npoints), idxs_to_delete)
-    for i in range(edges1.size):
-        edges1[i] = np.where(sampled_indices == edges1[i])[0][0]
-        edges2[i] = np.where(sampled_indices == edges2[i])[0][0]
+    remap = -np.ones(npoints, dtype = np.int64)
+    remap[sampled_indices] = np.arange(sampled_indices.size)
+    edges1 = remap[edges1]
+    edges2 = remap[edges2]
+    if edges1.size > 0 and (np.min(edges1) < 0 or np.min(edges2) < 0):
+        raise ValueError('Edges are connected to deleted points.')
 
     return sampled_indices, edges1, edges2
 
@@ -252,15 +251,17 @@ def resample_points(points, edges1, edges2, indices, perc_points_to_keep,
 
     """
 
-    def modify_edges(edges1, edges2, ipoint_to_delete, ipoint_to_replace):
-        i1 = np.where(edges1 == ipoint_to_delete)[0]
-        if len(i1) != 0:
-            edges1[i1] = ipoint_to_replace
-
-        i2 = np.where(np.array(edges2) == ipoint_to_delete)[0]
-        if len(i2) != 0:
-            edges2[i2] = ipoint_to_replace
-        return edges1, edges2
+    def modify_edges(edges1, edges2, incident, ipoint_to_delete,
+                     ipoint_to_replace):
+        # only the edges incident to the deleted point need to be checked
+        modified = np.array(sorted(incident[ipoint_to_delete]), dtype = int)
+        edges1[modified[edges1[modified] == ipoint_to_delete]] = \
+            ipoint_to_replace
+        edges2[modified[edges2[modified] == ipoint_to_delete]] = \
+            ipoint_to_replace
+        incident[ipoint_to_replace].update(incident[ipoint_to_delete])
+        incident[ipoint_to_delete] = set()
+        return edges1, edges2, modified
     npoints = points.shape[0]
     npoints_to_keep = int(npoints * perc_points_to_keep)
     ipoints_to_delete = []
@@ -271,36 +272,56 @@ def resample_points(points, edges1, edges2, indices, perc_points_to_keep,
         for inlet in indices['inlet']:
             ipoints_to_delete.append(inlet + ip)
             ipoints_to_replace.append(inlet + remove_caps)
-            edges1, edges2 = modify_edges(edges1, edges2,
-                                          inlet + ip, inlet + remove_caps)
         for outlet in indices['outlets']:
             ipoints_to_delete.append(outlet - ip)
             ipoints_to_replace.append(outlet - remove_caps)
-            edges1, edges2 = modify_edges(edges1, edges2,
-                                          outlet - ip, outlet - remove_caps)
+
+    # the caps are removed at once
+    replace = compose_replacements(ipoints_to_delete, ipoints_to_replace,
+                                   npoints)
+    edges1 = replace[edges1]
+    edges2 = replace[edges2]
 
     for outlet in indices['outlets']:
         new_outlets.append(outlet - remove_caps)
 
     indices['outlets'] = new_outlets
-
+    outlets_set = set(new_outlets)
+
+    # edge lengths are stored in a heap so that we don't need to recompute all
+    # of them at every iteration. Entries are updated lazily: we push the new
+    # length of the edges that are modified and skip the outdated ones
+    lengths = np.linalg.norm(points[edges1,:] - points[edges2,:], axis = 1)
+    heap = [(length, iedge) for iedge, length in enumerate(lengths.tolist())]
+    heapq.heapify(heap)
+    # incident[i] contains the indices of the edges having node i as endpoint
+    incident = [set() for _ in range(npoints)]
+    for iedge, (e1, e2) in enumerate(zip(edges1.tolist(), edges2.tolist())):
+        incident[e1].add(iedge)
+        incident[e2].add(iedge)
     for _ in range(npoints - npoints_to_keep):
-        diff = np.linalg.norm(points[edges1,:] - points[edges2,:],
-                              axis = 1)
-        # we don't consider the points that we already deleted
-        diff[np.where(diff < 1e-13)[0]] = np.inf
-        mdiff = np.min(diff)
-        mind = np.where(np.abs(diff - mdiff) < 1e-12)[0][0]
-
-        if edges2[mind] not in new_outlets:
+        while True:
+            if len(heap) == 0:
+                raise ValueError('All edges have been collapsed.')
+            mdiff, mind = heapq.heappop(heap)
+            # we don't consider the points that we already deleted
+            if mdiff == lengths[mind] and mdiff >= 1e-13:
+                break
+
+        if edges2[mind] not in outlets_set:
             ipoint_to_delete = edges2[mind]
             ipoint_to_replace = edges1[mind]
         else:
             ipoint_to_delete = edges1[mind]
             ipoint_to_replace = edges2[mind]
 
-        edges1, edges2 = modify_edges(edges1, edges2,
-                                      ipoint_to_delete, ipoint_to_replace)
+        edges1, edges2, \
+        modified = modify_edges(edges1, edges2, incident,
+                                ipoint_to_delete, ipoint_to_replace)
+        lengths[modified] = np.linalg.norm(points[edges1[modified],:] - \
+                                           points[edges2[modified],:], axis = 1)
+        for iedge in modified:
+            heapq.heappush(heap, (lengths[iedge], iedge))
 
         ipoints_to_delete.append(ipoint_to_delete)
         ipoints_to_replace.append(ipoint_to_replace)
@@ -334,43 +355,58 @@ def dijkstra_algorithm(nodes, edges1, edges2, index):
             when traversing the graph
 
     """
-    nnodes = nodes.shape[0]
-    tovisit = np.arange(0,nnodes)
-    dists = np.ones((nnodes)) * np.infty
-    prevs = np.ones((nnodes)) * (-1)
-    b_edges = np.array([edges1,edges2]).transpose()
-
-    dists[index] = 0
-    while len(tovisit) != 0:
-        minindex = -1
-        minlen = np.infty
-        for iinde in range(len(tovisit)):
-            if dists[tovisit[iinde]] < minlen:
-                minindex = iinde
-                minlen = dists[tovisit[iinde]]
-
-        curindex = tovisit[minindex]
-        tovisit = np.delete(tovisit, minindex)
-
-        # find neighbors of curindex
-        inb = b_edges[np.where(b_edges[:,0] == curindex)[0],1]
-
-        for neib in inb:
-            if np.where(tovisit == neib)[0].size != 0:
-                alt = dists[curindex] + np.linalg.norm(nodes[curindex,:] - \
-                        nodes[neib,:])
-                if alt < dists[neib]:
-                    dists[neib] = alt
-                    prevs[neib] = curindex
+    dists, prevs = compute_path_distances(nodes, edges1, edges2, [index],
+                                          return_predecessors = True)
+    # unreachable nodes and the seed are marked with -1
+    prevs = prevs[0,:].astype(float)
+    prevs[prevs < 0] = -1
+    return dists[0,:], prevs
+
+def compute_path_distances(points, edges1, edges2, sources,
+                           return_predecessors = False):
+    """
+    Compute path distances.
+
+    Find the shortest path lengths from a set of source nodes to every other
+    node in the graph. All sources are processed at once with Dijkstra's
+    algorithm from scipy.sparse.csgraph.
+
+    Arguments:
+        points: n x 3 numpy array of point coordinates
+        edges1: numpy array containing indices of source nodes for every edge
+        edges2: numpy array containing indices of dest nodes for every edge
+        sources: list of indices of the seed nodes
+        return_predecessors (bool): if True, also return the previous nodes
+                                    explored when traversing the graph.
+                                    Default -> False
+
+    Returns:
+        k x n numpy array (k being the number of sources and n the total number
+            of nodes) containing all shortest path lengths
+        k x n numpy array containing the previous nodes explored when
+            traversing the graph (only if return_predecessors is True)
+
+    """
+    npoints = points.shape[0]
+    # duplicated edges would be summed when assembling the sparse matrix
+    edges = np.unique(np.stack((edges1, edges2)), axis = 1)
+    weights = np.linalg.norm(points[edges[0],:] - points[edges[1],:], axis = 1)
+    adjacency = sparse.csr_matrix((weights, (edges[0], edges[1])),
+                                  shape = (npoints, npoints))
+    dists, prevs = csgraph.dijkstra(adjacency, directed = True,
+                                    indices = sources,
+                                    return_predecessors = True)
     if np.max(dists) == np.infty:
         plt.figure()
         ax = plt.axes(projection='3d')
-        ax.scatter(nodes[:,0], nodes[:,1], nodes[:,2], s = 0.5, c = 'black')
-        idx = np.where(dists > 1e30)[0]
-        ax.scatter(nodes[idx,0], nodes[idx,1], nodes[idx,2], c = 'red')
+        ax.scatter(points[:,0], points[:,1], points[:,2], s = 0.5, c = 'black')
+        idx = np.where(np.max(dists, axis = 0) > 1e30)[0]
+        ax.scatter(points[idx,0], points[idx,1], points[idx,2], c = 'red')
         plt.show()
         raise ValueError("Distance in Dijkstra is infinite for some reason. You can try to adjust resample parameters.")
-    return dists, prevs
+    if return_predecessors:
+        return dists, prevs
+    return dists
 
 def generate_boundary_edges(points, indices, edges1, edges2):
     """
@@ -391,66 +427,33 @@ def generate_boundary_edges(points, indices, edges1, edges2):
         n x 3 numpy array containing (x_j - x_i) / |x_j - x_i|
         n dimensional numpy array containing, for every node, its distance to
             the closest boundary node (in terms of path length)
+        numpy array containing edge types (2 for inlet, 3 for outlets)
 
     """
     npoints = points.shape[0]
     idxs = indices['inlet'] + indices['outlets']
-    bedges1 = []
-    bedges2 = []
-    rel_positions = []
-    dists = []
-    types = []
-    for index in idxs:
-        d, _ = dijkstra_algorithm(points, edges1, edges2, index)
-        if index in indices['inlet']:
-            type = 2
-        else:
-            type = 3
-        for ipoint in range(npoints):
-            bedges1.append(index)
-            bedges2.append(ipoint)
-            rp = points[ipoint,:] - points[index,:]
-            rel_positions.append(rp)
-            if np.linalg.norm(rp) > 1e-12:
-                rel_positions[-1] = rel_positions[-1] / np.linalg.norm(rp)
-            dists.append(d[ipoint])
-            types.append(type)
-
-        # DEBUG: check distances computed with dijkstra_algorithm
-        # fig = plt.figure()
-        # ax = plt.axes(projection='3d')
-        # for i in range(npoints):
-        #     ax.scatter(points[i,0], points[i,1], points[i,2], color = 'black', s = 1)
-        #     ax.text(points[i,0], points[i,1], points[i,2],
-        #             "{:.1f}".format(d[i]),
-        #             fontsize=5)
-        #     ax.set_box_aspect((np.ptp(points[:,0]),
-        #                np.ptp(points[:,1]),
-        #                np.ptp(points[:,2])))
-        # plt.show()
+    # we consider every edge between boundary nodes and graph nodes
+    dists = compute_path_distances(points, edges1, edges2, idxs)
+    rel_positions = points[None,:,:] - points[idxs,None,:]
+    norms = np.linalg.norm(rel_positions, axis = 2, keepdims = True)
+    rel_positions = np.where(norms > 1e-12,
+                             rel_positions / np.maximum(norms, 1e-12),
+                             rel_positions)
+    types = np.where(np.isin(idxs, indices['inlet']), 2, 3)
 
     # we only keep edges corresponding to the closest boundary node in graph
-    # distance to reduce number of edges
-    edges_to_delete = []
-
-    for ipoint in range(npoints):
-        cur_dists = dists[ipoint::npoints]
-        min_dist = np.min(cur_dists)
-        minidx = np.where(np.abs(cur_dists - min_dist) < 1e-12)[0][0]
-        if min_dist < 1e-12:
-            edges_to_delete.append(ipoint + minidx * npoints)
-        i = ipoint
-        while i < len(dists):
-            if i != ipoint + minidx * npoints:
-                edges_to_delete.append(i)
-            i = i + npoints
-
-    bedges1 = np.delete(np.array(bedges1), edges_to_delete)
-    bedges2 = np.delete(np.array(bedges2), edges_to_delete)
-    rel_positions = np.delete(np.array(rel_positions), edges_to_delete,
-                              axis = 0)
-    dists = np.delete(np.array(dists), edges_to_delete)
-    types = np.delete(np.array(types), edges_to_delete)
+    # distance to reduce number of edges. Boundary nodes are not connected to
+    # themselves
+    closest = np.argmin(dists, axis = 0)
+    keep = np.zeros(dists.shape, dtype = bool)
+    keep[closest, np.arange(npoints)] = True
+    keep[dists < 1e-12] = False
+
+    sources, bedges2 = np.nonzero(keep)
+    bedges1 = np.array(idxs)[sources]
+    rel_positions = rel_positions[keep]
+    dists = dists[keep]
+    types = types[sources]
 
     # make edges bidirectional
     bedges1_copy = bedges1.copy()
@@ -473,7 +476,7 @@ def generate_boundary_edges(points, indices, edges1, edges2):
     #             np.ptp(points[:,1]),
     #             np.ptp(points[:,2])))
     # plt.show()
-    return bedges1, bedges2, rel_positions, dists, list(types)
+    return bedges1, bedges2, rel_positions, dists, types
 
 def create_continuity_mask(types):
     """
@@ -488,14 +491,10 @@ def create_continuity_mask(types):
         n-dimensional numpy array containing 1s only at junction inlet indices
 
     """
-    continuity_mask = [0]
-    npoints = types.shape[0]
-    for i in range(1,npoints-1):
-        if types[i-1,0] == 1 and types[i,0] == 1 and types[i + 1,0]:
-            continuity_mask.append(1)
-        else:
-            continuity_mask.append(0)
-    continuity_mask.append(0)
+    branch = np.asarray(types[:,0]) == 1
+    continuity_mask = np.zeros(types.shape[0], dtype = int)
+    # a node is masked if it and both of its neighbors are branch nodes
+    continuity_mask[1:-1] = branch[:-2] & branch[1:-1] & branch[2:]
     return continuity_mask
 
 def create_junction_edges(points, bif_id, edges1, edges2, outlets):
@@ -518,11 +517,12 @@ def create_junction_edges(points, bif_id, edges1, edges2, outlets):
         n x 3 numpy array containing (x_j - x_i) / |x_j - x_i|
         n dimensional numpy array containing, for every node, its distance to
             the closest boundary node (in terms of path length)
-        list of n elements containing edge types (4)
+        numpy array containing edge types (4)
         dictionary containing masks for inlet nodes and inlet+outlet nodes
 
     """
     npoints = bif_id.size
+    outlets = set(outlets)
     jun_inlet_mask = [0] * npoints
     jun_mask = [0] * npoints
     juncts_inlets = {}
@@ -548,19 +548,15 @@ def create_junction_edges(points, bif_id, edges1, edges2, outlets):
             jedges2.append(ipoint)
             jun_mask[ipoint] = 1
     masks = {'inlets': jun_inlet_mask, 'all': jun_mask}
-    dists = {}
-    for jun_id in juncts_inlets:
-        d, _ = dijkstra_algorithm(points, edges1, edges2, juncts_inlets[jun_id])
-        dists[juncts_inlets[jun_id]] = d
-
-    jrel_position = []
-    jdistance = []
-    for iedg in range(len(jedges1)):
-        jrel_position.append(points[jedges2[iedg],:] - points[jedges1[iedg],:])
-        jdistance.append(dists[jedges1[iedg]][jedges2[iedg]])
-
-    jrel_position = np.array(jrel_position)
-    jdistance = np.array(jdistance)
+    je1 = np.array(jedges1, dtype = int)
+    je2 = np.array(jedges2, dtype = int)
+    jrel_position = points[je2,:] - points[je1,:]
+    jdistance = np.zeros(je1.size)
+    if len(juncts_inlets) > 0:
+        # different junctions can share the same inlet
+        sources = np.unique(list(juncts_inlets.values()))
+        dists = compute_path_distances(points, edges1, edges2, sources)
+        jdistance = dists[np.searchsorted(sources, je1), je2]
 
     # make edges bidirectional
     jedges1_copy = jedges1.copy()
@@ -568,7 +564,7 @@ def create_junction_edges(points, bif_id, edges1, edges2, outlets):
     jedges2 = jedges2 + jedges1_copy
     jrel_position = np.concatenate((jrel_position, -jrel_position), axis = 0)
     jdistance = np.concatenate((jdistance, jdistance))
-    types = [4] * len(jedges1)
+    types = np.full(len(jedges1), 4)
     return jedges1, jedges2, jrel_position, jdistance, types, masks
 
 def load_vtp(file, input_dir):
@@ -643,8 +639,7 @@ def generate_tangents(points, branch_id):
     # make sure tangents are unitary
     tangents = tangents / np.linalg.norm(tangents, axis = 0)
 
-    for i in range(tangents.shape[0]):
-        tangents[i] = tangents[i] / np.linalg.norm(tangents[i])
+    tangents = tangents / np.linalg.norm(tangents, axis = 1, keepdims = True)
 
     return tangents
 
@@ -725,11 +720,9 @@ def generate_graph(point_data, points, edges1, edges2,
                 rcr[ipoint,0] = rcr_values[id]['RP'][0]
             else:
                 raise ValueError('Unknown type of boundary conditions!')
-    etypes = [0] * edges1.size
     # we set etype to 1 if either of the nodes is a junction
-    for iedge in range(edges1.size):
-        if types[edges1[iedge],1] == 1 or types[edges2[iedge],1] == 1:
-            etypes[iedge] = 1
+    junction = types[:,1].detach().numpy() == 1
+    etypes = (junction[edges1] | junction[edges2]).astype(int)
 
     if add_boundary_edges:
         bedges1, bedges2, \
@@ -737,7 +730,7 @@ def generate_graph(point_data, points, edges1, edges2,
         btypes = generate_boundary_edges(points, indices, edges1, edges2)
         edges1 = np.concatenate((edges1, bedges1))
         edges2 = np.concatenate((edges2, bedges2))
-        etypes = etypes + btypes
+        etypes = np.concatenate((etypes, btypes))
         distance = np.concatenate((distance, bdistance))
         rel_position = np.concatenate((rel_position, brel_position), axis = 0)
 
@@ -750,7 +743,7 @@ def generate_graph(point_data, points, edges1, edges2,
                                                outlets)
         edges1 = np.concatenate((edges1, jedges1))
         edges2 = np.concatenate((edges2, jedges2))
-        etypes = etypes + jtypes
+        etypes = np.concatenate((etypes, jtypes))
         distance = np.concatenate((distance, jdistance))
         rel_position = np.concatenate((rel_position, jrel_position), axis = 0)
     else:
@@ -760,33 +753,37 @@ def generate_graph(point_data, points, edges1, edges2,
 
     graph = dgl.graph((edges1, edges2), idtype = th.int32)
 
-    graph.ndata['x'] = th.tensor(points, dtype = th.float32)
-    tangent = th.tensor(point_data['tangent'], dtype = th.float32)
+    # we use th.from_numpy to avoid copies when the arrays already have the
+    # right type
+    def to_tensor(array, dtype):
+        return th.from_numpy(np.ascontiguousarray(array, dtype = dtype))
+
+    graph.ndata['x'] = to_tensor(points, np.float32)
+    tangent = to_tensor(point_data['tangent'], np.float32)
     graph.ndata['tangent'] = th.unsqueeze(tangent, 2)
-    graph.ndata['area'] = th.reshape(th.tensor(area, dtype = th.float32),
-                                     (-1,1,1))
+    graph.ndata['area'] = th.reshape(to_tensor(area, np.float32), (-1,1,1))
     continuity_mask = create_continuity_mask(types)
 
     graph.ndata['type'] = th.unsqueeze(types, 2)
-    graph.ndata['inlet_mask'] = th.tensor(inlet_mask, dtype = th.int8)
-    graph.ndata['outlet_mask'] = th.tensor(outlet_mask, dtype = th.int8)
-    graph.ndata['continuity_mask'] = th.tensor(continuity_mask, dtype = th.int8)
-    graph.ndata['jun_inlet_mask'] = th.tensor(jmasks['inlets'], dtype = th.int8)
-    graph.ndata['jun_mask'] = th.tensor(jmasks['all'], dtype = th.int8)
-    graph.ndata['branch_mask'] = th.tensor(types[:,0].detach().numpy() == 1,
-                                           dtype = th.int8)
-    graph.ndata['branch_id'] = th.tensor(point_data['BranchId'],
-                                         dtype = th.int8)
-
-    graph.ndata['resistance1'] = th.reshape(th.tensor(rcr[:,0], dtype=th.float32), (-1,1,1))
-    graph.ndata['capacitance'] = th.reshape(th.tensor(rcr[:,1], dtype=th.float32), (-1,1,1))
-    graph.ndata['resistance2'] = th.reshape(th.tensor(rcr[:,2], dtype=th.float32), (-1,1,1))
-
-    graph.edata['rel_position'] = th.unsqueeze(th.tensor(rel_position,
-                                               dtype = th.float32), 2)
-    graph.edata['distance'] = th.reshape(th.tensor(distance,
-                                         dtype = th.float32), (-1,1,1))
-    etypes = th.nn.functional.one_hot(th.tensor(etypes), num_classes = 5)
+    graph.ndata['inlet_mask'] = to_tensor(inlet_mask, np.int8)
+    graph.ndata['outlet_mask'] = to_tensor(outlet_mask, np.int8)
+    graph.ndata['continuity_mask'] = to_tensor(continuity_mask, np.int8)
+    graph.ndata['jun_inlet_mask'] = to_tensor(jmasks['inlets'], np.int8)
+    graph.ndata['jun_mask'] = to_tensor(jmasks['all'], np.int8)
+    graph.ndata['branch_mask'] = to_tensor(types[:,0].detach().numpy() == 1,
+                                           np.int8)
+    graph.ndata['branch_id'] = to_tensor(point_data['BranchId'], np.int8)
+
+    graph.ndata['resistance1'] = th.reshape(to_tensor(rcr[:,0], np.float32), (-1,1,1))
+    graph.ndata['capacitance'] = th.reshape(to_tensor(rcr[:,1], np.float32), (-1,1,1))
+    graph.ndata['resistance2'] = th.reshape(to_tensor(rcr[:,2], np.float32), (-1,1,1))
+
+    graph.edata['rel_position'] = th.unsqueeze(to_tensor(rel_position,
+                                                         np.float32), 2)
+    graph.edata['distance'] = th.reshape(to_tensor(distance, np.float32),
+                                         (-1,1,1))
+    etypes = th.nn.functional.one_hot(th.from_numpy(etypes.astype(np.int64)),
+                                      num_classes = 5)
     graph.edata['type'] = th.unsqueeze(etypes, 2)
 
     return graph, indices, points, bif_id, edges1, edges2
@@ -811,7 +808,8 @@ def create_partitions(points, bif_id,
         list of partitions
     """
 
-    def create_partition(edges1, edges2, starting_point, inlets):
+    def create_partition(indptr, neighbors, starting_point, inlets):
+        inlets_set = set(inlets)
         sampling_indices = [starting_point]
         new_edges1 = []
         new_edges2 = []
@@ -822,15 +820,13 @@ def create_partitions(points, bif_id,
         while len(points_to_visit) > 0:
             j = points_to_visit[0]
             del points_to_visit[0]
-            iedges = np.where(edges1 == j)[0]
-            for iedg in iedges:
-                next_point = edges2[iedg]
+            for next_point in neighbors[indptr[j]:indptr[j + 1]]:
                 numbering[next_point] = count
                 count = count + 1
                 sampling_indices.append(next_point)
                 new_edges1.append(numbering[j])
                 new_edges2.append(numbering[next_point])
-                if next_point not in inlets:
+                if next_point not in inlets_set:
                     points_to_visit.append(next_point)
 
         return np.array(new_edges1), np.array(new_edges2), sampling_indices
@@ -838,6 +834,12 @@ def create_partitions(points, bif_id,
     bif_id = point_data['BifurcationId']
     npoints = bif_id.size
 
+    # adjacency in compressed sparse row format: the neighbors of node j are
+    # neighbors[indptr[j]:indptr[j+1]], in the same order as in edges1
+    order = np.argsort(edges1, kind = 'stable')
+    neighbors = edges2[order]
+    indptr = np.searchsorted(edges1[order], np.arange(npoints + 1))
+
     inlets = [0]
     # num_partions is the number of inlets that we have to randomly select from
     # the graph. So we start by randoming selecting one inlet between each
@@ -853,10 +855,9 @@ def create_partitions(points, bif_id,
             j = ipoint
             next = -1
             while True:
-                iedg = np.where(edges1 == j)[0]
-                if len(iedg) == 0:
+                if indptr[j] == indptr[j + 1]:
                     break
-                j = edges2[iedg[0]]
+                j = neighbors[indptr[j]]
                 if bif_id[j] != -1:
                     next = j
                     break
@@ -872,7 +873,7 @@ def create_partitions(points, bif_id,
     partitions = []
 
     for ipartition in range(len(inlets)):
-        pedges1, pedges2, sampling_indices = create_partition(edges1, edges2,
+        pedges1, pedges2, sampling_indices = create_partition(indptr, neighbors,
                                                             inlets[ipartition],
                                                             inlets)
         ppoints = points[sampling_indices,:]
@@ -997,17 +998,10 @@ if __name__ == "__main__":
             if len(flowrate) == 0:
                 flowrate = io.gather_array(point_data, 'velocity')
 
-            times = [t for t in pressure]
             timestep = float(dataset_info[file.replace('.vtp','')]['dt'])
-            for t in times:
-                pressure[t * timestep] = pressure[t]
-                flowrate[t * timestep] = flowrate[t]
-                del pressure[t]
-                del flowrate[t]
-
-            # scale pressure to be mmHg
-            for t in pressure:
-                pressure[t] = pressure[t] / 1333.2
+            # rescale time and scale pressure to be mmHg
+            pressure = {t * timestep: pressure[t] / 1333.2 for t in pressure}
+            flowrate = {t * timestep: flowrate[t] for t in flowrate}
 
             times = [t for t in pressure]
 
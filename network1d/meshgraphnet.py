@@ -27,7 +27,7 @@ from torch.nn import LayerNorm
 from torch.nn import Linear
 import torch.nn.functional as F
 import numpy as np
-import dgl.function as fn
+import dgl
 import graph1d.generate_normalized_graphs as nz
 import json
 
@@ -80,13 +80,30 @@ class MLP(Module):
         Forward step
 
         Arguments:
-            inp: input tensor
+            inp: input tensor, or list of tensors that would be concatenated
+                 along dimension 1 to form the input
+
+        Returns:
+            result of forward step
+
+        """
+        if isinstance(inp, (list, tuple)):
+            f = self.split_input(inp)
+        else:
+            f = self.input(inp)
+        return self.forward_latent(f)
+
+    def forward_latent(self, f):
+        """
+        Forward step starting from the output of the input layer
+
+        Arguments:
+            f: result of the input layer
 
         Returns:
             result of forward step
 
         """
-        f = self.input(inp)
         f = F.leaky_relu(f)
 
         for i in range(self.n_h_layers):
@@ -101,6 +118,52 @@ class MLP(Module):
 
         return f
 
+    def split_input(self, inps):
+        """
+        Apply input layer to a list of tensors
+
+        This is equivalent to self.input(th.cat(inps, 1)), but every tensor
+        is multiplied by the corresponding block of columns of the weight
+        matrix, which avoids allocating the concatenated input.
+
+        Arguments:
+            inps: list of input tensors
+
+        Returns:
+            result of the input layer
+
+        """
+        projs = self.project_input(inps)
+        f = projs[0]
+        for proj in projs[1:]:
+            f = f + proj
+        return f
+
+    def project_input(self, inps):
+        """
+        Project a list of tensors with the blocks of the input layer
+
+        The i-th tensor is multiplied by the block of columns of the weight
+        matrix that corresponds to its position in the concatenated input.
+        The bias is added to the first projection only, so that the sum of the
+        projections is equal to self.input(th.cat(inps, 1)).
+
+        Arguments:
+            inps: list of input tensors
+
+        Returns:
+            list of projected tensors
+
+        """
+        weight = self.input.weight
+        offset = inps[0].shape[1]
+        projs = [F.linear(inps[0], weight[:,:offset], self.input.bias)]
+        for inp in inps[1:]:
+            size = inp.shape[1]
+            projs.append(F.linear(inp, weight[:,offset:offset + size]))
+            offset = offset + size
+        return projs
+
 class EncodeProcessDecodeNetwork(Module):
     """
     EncodeProcessDecodeNetwork
@@ -159,6 +222,23 @@ class EncodeProcessDecodeNetwork(Module):
                           params['number_hidden_layers_mlp'],
                           False)
 
+    def compile_mlps(self):
+        """
+        Compile the MLPs with torch.compile
+
+        Operations on DGL graphs cannot be traced by torch.compile, so we only
+        compile the parts of the MLPs that act on tensors. The compiled
+        methods are set on the instances: parameters (and state_dict) are
+        not affected.
+
+        """
+        mlps = [self.encoder_nodes, self.encoder_edges, self.output]
+        mlps = mlps + list(self.processor_nodes) + list(self.processor_edges)
+        for mlp in mlps:
+            # batched graphs have variable number of nodes and edges
+            mlp.forward_latent = th.compile(mlp.forward_latent, dynamic = True)
+            mlp.project_input = th.compile(mlp.project_input, dynamic = True)
+
     def encode_edges(self, edges):
         """
         Encode graph edges
@@ -173,44 +253,59 @@ class EncodeProcessDecodeNetwork(Module):
         enc_features = self.encoder_edges(edges.data['efeatures'])
         return {'proc_edge': enc_features}
 
-    def process_edges(self, edges, index):
+    def precompute_edge_encoding(self, g):
         """
-        Process graph edges
+        Precompute encoded edge features
+
+        Edge features are static (e.g., during rollout), so they can be
+        encoded once. The result is stored in g.edata['proc_edge_enc0'] and
+        reused by forward. The cache must be recomputed if the edge features
+        or the parameters of the network change.
 
         Arguments:
-            edges: graph edges
-            index: iteration index
+            g: the graph
 
-        Returns:
-            dictionary (key: 'proc_edge', value: processed features)
+        """
+        g.edata['proc_edge_enc0'] = self.encoder_edges(g.edata['efeatures'])
+
+    def process_edges(self, g, processor):
+        """
+        Process graph edges
+
+        The result is stored in g.edata['proc_edge'].
+
+        Arguments:
+            g: the graph
+            processor: MLP processing the edges
 
         """
-        f1 = edges.data['proc_edge']
-        f2 = edges.src['proc_node']
-        f3 = edges.dst['proc_node']
-        proc_edge = self.processor_edges[index](th.cat((f1, f2, f3), 1))
+        f1 = g.edata['proc_edge']
+        f2 = g.ndata['proc_node']
+        # the input layer is linear: instead of applying it to the
+        # concatenation of edge, source and dest features, we project the node
+        # features once per node and sum the projections on the edges
+        f_edge, f_src, f_dst = processor.project_input((f1, f2, f2))
+        f = f_edge + dgl.ops.u_add_v(g, f_src, f_dst)
+        proc_edge = processor.forward_latent(f)
         # add residual connection
-        proc_edge = proc_edge + f1
-        return {'proc_edge': proc_edge}
+        g.edata['proc_edge'] = proc_edge + f1
 
-    def process_nodes(self, nodes, index):
+    def process_nodes(self, g, processor):
         """
         Process graph nodes
 
-        Arguments:
-            nodes: graph nodes
-            index: iteration index
+        The result is stored in g.ndata['proc_node'].
 
-        Returns:
-            dictionary (key: 'proc_node', value: processed features)
+        Arguments:
+            g: the graph
+            processor: MLP processing the nodes
 
         """
-        f1 = nodes.data['proc_node']
-        f2 = nodes.data['pe_sum']
-        proc_node = self.processor_nodes[index](th.cat((f1, f2), 1))
+        f1 = g.ndata['proc_node']
+        f2 = g.ndata['pe_sum']
+        proc_node = processor((f1, f2))
         # add residual connection
-        proc_node = proc_node + f1
-        return {'proc_node': proc_node}
+        g.ndata['proc_node'] = proc_node + f1
 
     def decode_nodes(self, nodes):
         """
@@ -256,11 +351,12 @@ class MeshGraphNet(EncodeProcessDecodeNetwork):
 
         """
         inmask = nodes.data['inlet_mask'].bool()
-        nnodes = inmask.shape[0]
-        nf = th.zeros((nnodes,1))
-        nf[inmask] = th.unsqueeze(nodes.data['next_flowrate'][inmask],1)
-
-        features = th.cat((nodes.data['nfeatures'], nf), 1)
+        nfeatures = nodes.data['nfeatures']
+        nnodes, nnf = nfeatures.shape
+        # the last column contains the next flowrate at the inlet
+        features = nfeatures.new_zeros((nnodes, nnf + 1))
+        features[:,:nnf] = nfeatures
+        features[inmask,nnf] = nodes.data['next_flowrate'][inmask]
         enc_features = self.encoder_nodes(features)
         return {'proc_node': enc_features}
 
@@ -279,12 +375,18 @@ class MeshGraphNet(EncodeProcessDecodeNetwork):
             sum of mass loss occurring at branches and at junctions
 
         """
-        g.ndata['next_flowrate'] = flowrate.clone()
-
         # we zero-out inlet and outlet flowrate (otherwise they would send
-        # their flowrate to branch and junction nodes)
-        g.ndata['next_flowrate'][g.ndata['inlet_mask'].bool()] = 0
-        g.ndata['next_flowrate'][g.ndata['outlet_mask'].bool()] = 0
+        # their flowrate to branch and junction nodes) and keep flowrate at
+        # inlet and outlets of junctions. This is done in a single product to
+        # avoid copies and masked writes. The gate is static and precomputed
+        # by the dataset when available
+        if 'flow_gate' in g.ndata:
+            gate = g.ndata['flow_gate']
+        else:
+            gate = g.ndata['jun_mask'] * \
+                   ~(g.ndata['inlet_mask'].bool() | \
+                     g.ndata['outlet_mask'].bool())
+        g.ndata['flow_junction'] = flowrate * gate
 
         # # we send flowrate through branches, compute the mean
         # # of neighboring nodes, and compute the diff with our estimate
@@ -298,15 +400,12 @@ class MeshGraphNet(EncodeProcessDecodeNetwork):
         # else:
         #     branch_continuity = th.sum(diff)
 
-        # we keep flowrate at inlet and outlets of junctions
-        g.ndata['flow_junction'] = g.ndata['next_flowrate'] * \
-                                   g.ndata['jun_mask']
-
-        g.update_all(fn.copy_u('flow_junction', 'm'), 
-                     fn.sum('m', 'sum_flowrate'))
+        g.ndata['sum_flowrate'] = dgl.ops.copy_u_sum(g,
+                                                     g.ndata['flow_junction'])
 
-        # we use the inlet to compute the difference
-        diff = th.abs(g.ndata['sum_flowrate'] - g.ndata['next_flowrate'])
+        # we use the inlet to compute the difference (jun_mask is 1 at junction
+        # inlets, so flow_junction equals the zeroed-out flowrate there)
+        diff = th.abs(g.ndata['sum_flowrate'] - g.ndata['flow_junction'])
         diff = diff * g.ndata['jun_inlet_mask']
 
         if take_mean:
@@ -345,18 +444,20 @@ class MeshGraphNet(EncodeProcessDecodeNetwork):
 
         """
         g.apply_nodes(self.encode_nodes)
-        g.apply_edges(self.encode_edges)
+        if 'proc_edge_enc0' in g.edata:
+            g.edata['proc_edge'] = g.edata['proc_edge_enc0']
+        else:
+            g.apply_edges(self.encode_edges)
         
-        for index in range(self.process_iters):
-            def process_edges(edges):
-                return self.process_edges(edges, index)
-            def process_nodes(nodes):
-                return self.process_nodes(nodes, index)
+        # we iterate over the modules directly (no closures capturing the
+        # iteration index)
+        for processor_edges, processor_nodes in zip(self.processor_edges,
+                                                    self.processor_nodes):
             # compute junction-branch interactions
-            g.apply_edges(process_edges)
-            g.update_all(fn.copy_e('proc_edge', 'm'), 
-                         fn.sum('m', 'pe_sum'))
-            g.apply_nodes(process_nodes)
+            self.process_edges(g, processor_edges)
+            # fused kernel: messages are not materialized
+            g.ndata['pe_sum'] = dgl.ops.copy_e_sum(g, g.edata['proc_edge'])
+            self.process_nodes(g, processor_nodes)
 
         g.apply_nodes(self.decode_nodes)
 
@@ -24,6 +24,7 @@ sys.path.append(os.getcwd())
 import graph1d.generate_normalized_graphs as nz
 import numpy as np
 import torch as th
+import dgl
 import copy
 import time
 
@@ -109,22 +110,38 @@ def compute_average_branches(graph, flowrate):
     """
     Average flowrate over branch nodes
 
+    If the graph is batched, branches of different graphs are averaged
+    separately.
+
     Arguments:
         graph: DGL graph
         flowrate: 1D tensor containing nodal flow rate values
 
     """
-    branch_id = graph.ndata['branch_id'].detach().numpy()
-    bmax = np.max(branch_id)
-    for i in range(bmax + 1):
-        idxs = np.where(branch_id == i)[0]
-        rflowrate = th.mean(flowrate[idxs])
-        flowrate[idxs] = rflowrate
+    branch_id = graph.ndata['branch_id'].long()
+    # nodes with negative branch id do not belong to any branch
+    valid = branch_id >= 0
+    if not th.any(valid):
+        return
+    graph_id = th.repeat_interleave(th.arange(graph.batch_size,
+                                              device = branch_id.device),
+                                    graph.batch_num_nodes())
+    key = graph_id[valid] * (th.max(branch_id) + 1) + branch_id[valid]
+    _, inverse = th.unique(key, return_inverse = True)
+    sums = th.zeros(int(th.max(inverse)) + 1, dtype = flowrate.dtype,
+                    device = flowrate.device)
+    sums = sums.index_add(0, inverse, flowrate[valid])
+    counts = th.bincount(inverse, minlength = sums.shape[0])
+    flowrate[valid] = (sums / counts)[inverse]
 
 def rollout(gnn_model, params, graph, average_branches = True):
     """
     Performs rollout phase.
 
+    If graph is a batch of graphs (with the same number of timesteps), all
+    graphs are rolled out together and the errors are computed for each of
+    them.
+
     Arguments:
         gnn_model: the GNN
         params: dictionary of parameters
@@ -135,22 +152,30 @@ def rollout(gnn_model, params, graph, average_branches = True):
     Returns:
         2D array of reconstructed features, where dim 1 corresponds to node 
             indices and dim 2 corresponds to pressure (0) and flow rate (1),
-        2D array containing normalized pressure and flow rate relative errors
-        2D array containing pressure and flow rate relative errors
+        array containing normalized pressure and flow rate relative errors
+            (one row per graph if graph is batched)
+        array containing pressure and flow rate relative errors (one row per
+            graph if graph is batched)
         2D array containing the difference of reconstructed and actual features
         Relative continuity loss
         Elapsed time in seconds
 
     """
     gnn_model.eval()
+    device = next(gnn_model.parameters()).device
     times = graph.ndata['nfeatures'].shape[2]
-    graph = copy.deepcopy(graph)
+    graph = copy.deepcopy(graph).to(device)
     true_graph = copy.deepcopy(graph)
 
     tfc = true_graph.ndata['nfeatures'].clone()
     graph.ndata['nfeatures'] = tfc[:,:,0].clone()
     graph.edata['efeatures'] = true_graph.edata['efeatures'].squeeze().clone()
 
+    # edge features do not change during rollout: we encode them only once
+    model = gnn_model.module if hasattr(gnn_model, 'module') else gnn_model
+    with th.no_grad():
+        model.precompute_edge_encoding(graph)
+
     r_features = graph.ndata['nfeatures'][:,0:2].unsqueeze(axis = 2).clone()
     start = time.time()
     for it in range(times-1):
@@ -168,6 +193,18 @@ def rollout(gnn_model, params, graph, average_branches = True):
         # graph.ndata['nfeatures'][:,0:2] = tfc[:,0:2,it + 1].clone()
 
     end = time.time()
+
+    def relative_errors(tfc, rfc):
+        # we sum over time and over the nodes of every graph in the batch
+        seglen = graph.batch_num_nodes()
+        num = dgl.ops.segment_reduce(seglen, th.sum((tfc - rfc)**2, dim = 2),
+                                     'sum')
+        den = dgl.ops.segment_reduce(seglen, th.sum(tfc**2, dim = 2), 'sum')
+        errs = th.sqrt(num / den)
+        if graph.batch_size == 1:
+            errs = errs[0]
+        return errs
+
     tfc = true_graph.ndata['nfeatures'][:,0:2,:].clone()
 
     rfc = r_features.clone()
@@ -179,11 +216,7 @@ def rollout(gnn_model, params, graph, average_branches = True):
     # compute error
     tfc = tfc * branch_mask
     rfc = rfc * branch_mask
-    diff = tfc - rfc
-
-    errs = th.sum(th.sum(diff**2, dim = 0), dim = 1)
-    errs = errs / th.sum(th.sum(tfc**2, dim = 0), dim = 1)
-    errs_normalized = th.sqrt(errs)
+    errs_normalized = relative_errors(tfc, rfc)
 
     tfc[:,0,:] = nz.invert_normalize(tfc[:,0,:], 'pressure', 
                                      params['statistics'], 'features')
@@ -196,12 +229,12 @@ def rollout(gnn_model, params, graph, average_branches = True):
                                      params['statistics'], 'features')
 
     diff = tfc - rfc
-    errs = th.sum(th.sum(diff**2, dim = 0), dim = 1)
-    errs = errs / th.sum(th.sum(tfc**2, dim = 0), dim = 1)
-    errs = th.sqrt(errs)
+    errs = relative_errors(tfc, rfc)
 
-    return r_features.detach().numpy(), errs_normalized.detach().numpy(), \
-           errs.detach().numpy(), np.abs(diff.detach().numpy()), end - start
+    return r_features.numpy(force = True), \
+           errs_normalized.numpy(force = True), \
+           errs.numpy(force = True), np.abs(diff.numpy(force = True)), \
+           end - start
 
     
 
@@ -34,6 +34,7 @@ import pathlib
 from torch.utils.data.distributed import DistributedSampler
 from torch.utils.data.sampler import SubsetRandomSampler
 from dgl.dataloading import GraphDataLoader
+import dgl
 from tqdm import tqdm
 from network1d.rollout import rollout
 from network1d.rollout import perform_timestep
@@ -137,6 +138,8 @@ def evaluate_model(gnn_model, train_dataloader, test_dataloader, optimizer,
         Elapsed time in seconds
 
     """
+    device = next(gnn_model.parameters()).device
+
     def loop_over(dataloader, label, c_optimizer = None):
         """
         Performs one epoch by looping over all batches in the dataloader.
@@ -152,8 +155,9 @@ def evaluate_model(gnn_model, train_dataloader, test_dataloader, optimizer,
                 loss
 
         """
-        global_loss = 0
-        global_metric = 0
+        # accumulators live on the device: we synchronize only once per epoch
+        global_loss = th.zeros((), device = device)
+        global_metric = th.zeros((), device = device)
         count = 0
 
         def iteration(batched_graph, c_optimizer):
@@ -171,22 +175,28 @@ def evaluate_model(gnn_model, train_dataloader, test_dataloader, optimizer,
                 Continuity loss value
 
             """
+            if device.type == 'cuda':
+                # we pin the batch (in place) so that the copy to the gpu does
+                # not block the host, which can keep queueing kernels.
+                # host_graph keeps the pinned memory alive during the copy
+                host_graph = batched_graph.pin_memory_()
+                batched_graph = host_graph.to(device, non_blocking = True)
+            else:
+                batched_graph = batched_graph.to(device)
             batched_graph_c = copy.deepcopy(batched_graph)
+            dset.add_noise(batched_graph_c, params)
             ns = batched_graph_c.ndata['next_steps']
             loss_v = 0
             metric_v = 0
-            mask = th.ones(ns[:,:,0].shape)
-            inmask = batched_graph.ndata['inlet_mask'].bool()
-            outmask = batched_graph.ndata['outlet_mask'].bool()
-
-            bccoeff = 100
-            mask[inmask,0] = mask[inmask,0] * bccoeff
-            # flow rate is known
-            mask[outmask,0] = mask[outmask,0] * bccoeff
-            mask[outmask,1] = mask[outmask,1] * bccoeff
+            # the mask is precomputed when the dataset is processed
+            mask = batched_graph.ndata['train_mask']
             for istride in range(params['stride']):
-                nf = perform_timestep(gnn_model, params, batched_graph_c, ns, 
-                                      istride)
+                # LayerNorm and reductions are kept in float32 by autocast
+                with th.autocast(device_type = device.type,
+                                 dtype = th.bfloat16,
+                                 enabled = params.get('bf16', False)):
+                    nf = perform_timestep(gnn_model, params, batched_graph_c,
+                                          ns, istride)
 
                 batched_graph_c.ndata['nfeatures'][:,0:2] = nf
 
@@ -202,29 +212,31 @@ def evaluate_model(gnn_model, train_dataloader, test_dataloader, optimizer,
                 metric_v = metric_v + coeff * mae(nf, ns[:,:,istride], mask)
 
             if c_optimizer != None:
-                optimizer.zero_grad()
+                optimizer.zero_grad(set_to_none = True)
                 loss_v.backward()
                 optimizer.step()
             
-            return loss_v.detach().numpy(), metric_v.detach().numpy()
+            # we keep the values on the device to avoid synchronizing at
+            # every batch
+            return loss_v.detach(), metric_v.detach()
 
 
         if not print_progress:
             for batched_graph in dataloader:
                 loss_v, metric_v = iteration(batched_graph, c_optimizer)
-                global_loss = global_loss + loss_v
-                global_metric = global_metric + metric_v
+                global_loss += loss_v
+                global_metric += metric_v
                 count = count + 1
         else:
             for batched_graph in tqdm(dataloader, 
                                     desc = label, colour='green'):
                 loss_v, metric_v = iteration(batched_graph, c_optimizer)
-                global_loss = global_loss + loss_v
-                global_metric = global_metric + metric_v
+                global_loss += loss_v
+                global_metric += metric_v
                 count = count + 1
 
-        return {'loss': global_loss / count, 
-                'metric': global_metric / count}
+        return {'loss': (global_loss / count).item(), 
+                'metric': (global_metric / count).item()}
 
     gnn_model.train()
     start = time.time()
@@ -250,21 +262,24 @@ def compute_rollout_errors(gnn_model, params, dataset, idxs_train, idxs_test):
         2D array containing the error for pressure and flow rate (test)
 
     """
-    train_errs = np.zeros(2)
-    for idx in idxs_train:
-        _, cur_train_errs, _, _, _ = rollout(gnn_model, params, 
-                                             dataset['train'].graphs[idx])
-        train_errs = cur_train_errs + train_errs
-    
-    train_errs = train_errs / len(idxs_train)
-
-    test_errs = np.zeros(2)
-    for idx in idxs_test:
-        _, cur_test_errs, _, _, _ = rollout(gnn_model, params, 
-                                            dataset['test'].graphs[idx])
-        test_errs = cur_test_errs + test_errs
-
-    test_errs = test_errs / (len(idxs_test))
+    def average_errors(graphs):
+        # graphs with the same number of timesteps are batched and rolled out
+        # together
+        groups = {}
+        for graph in graphs:
+            ntimes = graph.ndata['nfeatures'].shape[2]
+            groups.setdefault(ntimes, []).append(graph)
+
+        errs = np.zeros(2)
+        for group in groups.values():
+            _, cur_errs, _, _, _ = rollout(gnn_model, params, dgl.batch(group))
+            errs = errs + np.sum(np.reshape(cur_errs, (-1, 2)), axis = 0)
+        return errs / len(graphs)
+
+    train_errs = average_errors([dataset['train'].graphs[idx] \
+                                 for idx in idxs_train])
+    test_errs = average_errors([dataset['test'].graphs[idx] \
+                                for idx in idxs_test])
 
     return train_errs, test_errs
 
@@ -307,15 +322,32 @@ def train_gnn_model(gnn_model, dataset, params, parallel, doprint = True):
         num_test = int(len(dataset['test']))
         test_sampler = SubsetRandomSampler(th.arange(num_test))
     
+    # workers are kept alive across epochs so that they are not forked again
+    # at every epoch
+    num_workers = params.get('num_workers', 0)
     train_dataloader = GraphDataLoader(dataset['train'], 
                                        sampler = train_sampler,
                                        batch_size = batch_size,
-                                       drop_last = False)
+                                       drop_last = False,
+                                       num_workers = num_workers,
+                                       persistent_workers = num_workers > 0)
 
     test_dataloader = GraphDataLoader(dataset['test'], 
                                       sampler = test_sampler,
                                       batch_size = batch_size,
-                                      drop_last = False)
+                                      drop_last = False,
+                                      num_workers = num_workers,
+                                      persistent_workers = num_workers > 0)
+
+    # batching is expensive: if requested, we batch the graphs only once and
+    # shuffle the order of the batches at every epoch
+    cache_batches = params.get('cache_batches', False)
+    if cache_batches:
+        train_batches = [batched_graph for batched_graph in train_dataloader]
+        test_batches = [batched_graph for batched_graph in test_dataloader]
+    else:
+        train_batches = train_dataloader
+        test_batches = test_dataloader
 
     lr = params['learning_rate']
     if parallel:
@@ -334,6 +366,21 @@ def train_gnn_model(gnn_model, dataset, params, parallel, doprint = True):
                                                         T_max = nepochs,
                                                         eta_min = eta_min)
 
+    if params.get('compile', False):
+        # batched graphs have different sizes: we allow more recompilations
+        # before falling back to eager mode
+        th._dynamo.config.cache_size_limit = 64
+        # warmup: one forward and backward pass (without optimizer step) so
+        # that the compilation time is not charged to the first epoch
+        device = next(gnn_model.parameters()).device
+        batched_graph = copy.deepcopy(next(iter(train_batches)).to(device))
+        ns = batched_graph.ndata['next_steps']
+        with th.autocast(device_type = device.type, dtype = th.bfloat16,
+                         enabled = params.get('bf16', False)):
+            nf = perform_timestep(gnn_model, params, batched_graph, ns, 0)
+        mse(nf, ns[:,:,0], batched_graph.ndata['train_mask']).backward()
+        optimizer.zero_grad(set_to_none = True)
+
     countp = 0
 
     # sample train and test graphs for rollout
@@ -353,10 +400,13 @@ def train_gnn_model(gnn_model, dataset, params, parallel, doprint = True):
         if doprint:
             print('================{}================'.format(epoch))
 
+        if cache_batches:
+            random.shuffle(train_batches)
+
         signal.signal(signal.SIGINT, s.handle)
         train_results, test_results, elapsed = evaluate_model(gnn_model,
-                                                              train_dataloader,
-                                                              test_dataloader,
+                                                              train_batches,
+                                                              test_batches,
                                                               optimizer,
                                                               rank == 0,
                                                               params)
@@ -426,12 +476,20 @@ def launch_training(dataset, params, parallel, out_dir = 'models/'):
     now = datetime.now()
     folder = out_dir + now.strftime("%d.%m.%Y_%H.%M.%S")
 
-    gnn_model = MeshGraphNet(params)
+    # with the mpi backend gradients are reduced on cpu
+    use_cuda = th.cuda.is_available()
+    if parallel:
+        use_cuda = use_cuda and dist.get_backend() == 'nccl'
+    device = th.device('cuda' if use_cuda else 'cpu')
+    gnn_model = MeshGraphNet(params).to(device)
+    # we keep a reference to the original module so that saved parameters do
+    # not depend on parallel wrappers
+    base_model = gnn_model
     def save_model(filename):
-        if parallel:
-            th.save(gnn_model.module.state_dict(), folder + '/' + filename)
-        else:
-            th.save(gnn_model.state_dict(),  folder + '/' + filename)
+        state_dict = base_model.state_dict()
+        # we always save on cpu so that models can be loaded without gpus
+        state_dict = {k: v.cpu() for k, v in state_dict.items()}
+        th.save(state_dict, folder + '/' + filename)
 
     def default(obj):
         if isinstance(obj, th.Tensor):
@@ -443,9 +501,22 @@ def launch_training(dataset, params, parallel, out_dir = 'models/'):
         print(obj)
         raise TypeError('Not serializable')
 
+    if params.get('compile', False):
+        # operations on DGL graphs cannot be traced: we only compile the MLPs
+        gnn_model.compile_mlps()
+
     save_data = True
     if parallel:
-        gnn_model = th.nn.parallel.DistributedDataParallel(gnn_model)
+        device_ids = None
+        if device.type == 'cuda':
+            device_ids = [th.cuda.current_device()]
+        # the model is composed of many small MLPs: smaller buckets and
+        # gradients stored directly in the buckets reduce the overhead
+        gnn_model = th.nn.parallel.DistributedDataParallel(gnn_model,
+                                            device_ids = device_ids,
+                                            find_unused_parameters = False,
+                                            bucket_cap_mb = 10,
+                                            gradient_as_bucket_view = True)
         save_data = (dist.get_rank() == 0)
 
     if save_data:
@@ -519,6 +590,14 @@ def parse_command_line_arguments():
                         type=int, default=5)
     parser.add_argument('--bcs_gnn', help='path to graph for bcs',
                         type=str, default='models_bcs/31.10.2022_01.35.31')
+    parser.add_argument('--compile', help='compile model with torch.compile',
+                        action='store_true')
+    parser.add_argument('--bf16', help='use bfloat16 autocast in training',
+                        action='store_true')
+    parser.add_argument('--cache_batches', help='batch graphs only once',
+                        action='store_true')
+    parser.add_argument('--num_workers', help='number of dataloader workers',
+                        type=int, default=0)
     args = parser.parse_args()
 
     # we create a dictionary with all the parameters
@@ -534,7 +613,11 @@ def parse_command_line_arguments():
                 'rate_noise': args.rate_noise,
                 'rate_noise_features': args.rate_noise_features,
                 'stride': args.stride,
-                'bcs_gnn': args.bcs_gnn}
+                'bcs_gnn': args.bcs_gnn,
+                'compile': args.compile,
+                'bf16': args.bf16,
+                'cache_batches': args.cache_batches,
+                'num_workers': args.num_workers}
 
     return t_params, args
 
@@ -648,15 +731,31 @@ data_location/graphs. The trained model is saved by default in a folder called
 """
 if __name__ == "__main__":
     rank = 0
+    # use tensor cores (TF32) for matmuls and let cudnn pick the fastest
+    # algorithms for our fixed layer sizes
+    th.backends.cuda.matmul.allow_tf32 = True
+    th.backends.cudnn.allow_tf32 = True
+    th.backends.cudnn.benchmark = True
     try:
         parallel = True
-        dist.init_process_group(backend='mpi')
+        # nccl requires gpus and env:// rendezvous (e.g., torchrun); we use
+        # mpi otherwise (e.g., when launched with mpirun)
+        backend = 'mpi'
+        if th.cuda.is_available() and 'MASTER_ADDR' in os.environ:
+            backend = 'nccl'
+        dist.init_process_group(backend=backend)
         rank = dist.get_rank()
         print("my rank = %d, world = %d." % (rank, dist.get_world_size()), flush=True)
-        th.backends.cudnn.enabled = False
-    except RuntimeError:
+        if backend == 'nccl':
+            local_rank = int(os.environ.get('LOCAL_RANK',
+                                            rank % th.cuda.device_count()))
+            th.cuda.set_device(local_rank)
+        else:
+            th.backends.cudnn.enabled = False
+    except RuntimeError as e:
         parallel = False
-        print("MPI not supported. Running serially.")
+        print(e)
+        print("Distributed training not supported. Running serially.")
 
     # 'synthetic' refers to the bcs, not the geometry
     types_to_keep = ['synthetic_aorta_coarctation', 
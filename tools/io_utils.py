@@ -267,21 +267,19 @@ def write_solution(graph, solution, outfile, outdir = '.'):
     if outdir != '.':
         create_directory(outdir)
 
-    for t in range(ntimesteps):
+    # the geometry does not change in time: we convert it only once
+    points = graph.ndata['x'].numpy(force = True)
+    edges0, edges1 = [e.numpy(force = True) for e in graph.edges()]
 
-        points = graph.ndata['x'].detach().numpy()
-        edges0 = graph.edges()[0].detach().numpy()
-        edges1 = graph.edges()[1].detach().numpy()
+    type = np.argmax(graph.edata['type'].numpy(force = True), axis = 1)
 
-        type = np.argmax(graph.edata['type'].detach().numpy(),
-                     axis = 1)
-        
-        p_edges = np.where(type < 2)[0]
+    p_edges = np.where(type < 2)[0]
 
-        cells = {
-            'line': np.vstack((edges0[p_edges], edges1[p_edges])).transpose()
-        }
+    cells = {
+        'line': np.vstack((edges0[p_edges], edges1[p_edges])).transpose()
+    }
 
+    for t in range(ntimesteps):
         point_data = {
             'pressure': solution[0][:,0,t],
             'flowrate': solution[1][:,0,t]
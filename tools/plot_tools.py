@@ -27,15 +27,10 @@ import graph1d.generate_normalized_graphs as gng
 import matplotlib
 from matplotlib import animation
 import torch as th
-import os
-import vtk
-from vtk.util.numpy_support import vtk_to_numpy
 from random import sample
-import graph1d.generate_normalized_graphs as nz
 import matplotlib.cm as cm
 # from stl import mesh
 from mpl_toolkits import mplot3d
-from matplotlib import pyplot
 import matplotlib.ticker as ticker
 
 # some colors
@@ -76,12 +71,9 @@ def plot_graph(points, bif_id, indices, edges1, edges2,
     ax = plt.axes(projection='3d')
     ax._axis3don = False
 
-    np.min(bif_id)
-    np.max(bif_id)
-
-    branch_nodes = np.where(bif_id == -1)[0]
-    branch_nodes = branch_nodes[1:]
-    jun_nodes = np.where(bif_id > -1)[0]
+    is_branch = bif_id == -1
+    branch_nodes = np.flatnonzero(is_branch)[1:]
+    jun_nodes = np.flatnonzero(~is_branch)
 
     ax.scatter(points[branch_nodes,0], 
                points[branch_nodes,1], 
@@ -101,15 +93,14 @@ def plot_graph(points, bif_id, indices, edges1, edges2,
     outlets = indices['outlets']
     ax.scatter(points[outlets,0], points[outlets,1], points[outlets,2],color='red', depthshade=0, s = s * 10)
 
-    for iedge in range(edges1.size):
-        ax.plot3D([points[edges1[iedge],0],points[edges2[iedge],0]],
-                  [points[edges1[iedge],1],points[edges2[iedge],1]],
-                  [points[edges1[iedge],2],points[edges2[iedge],2]],
-                   color = 'black', linewidth = linewidth, alpha = 0.5)
+    # all edges are drawn as a single collection (E x 2 x 3 segments)
+    segments = np.stack((points[edges1,:], points[edges2,:]), axis = 1)
+    ax.add_collection3d(mplot3d.art3d.Line3DCollection(segments,
+                                                       colors = 'black',
+                                                       linewidths = linewidth,
+                                                       alpha = 0.5))
 
-    ax.set_box_aspect((np.ptp(points[:,0]), 
-                       np.ptp(points[:,1]), 
-                       np.ptp(points[:,2])))
+    ax.set_box_aspect(tuple(np.ptp(points, axis = 0)))
     if stl_mesh != None:
         ax.add_collection3d(mplot3d.art3d.Poly3DCollection(stl_mesh.vectors,
                             alpha=0.08))
@@ -143,12 +134,12 @@ def plot_history(history_train, history_test, label, folder = None):
     plt.legend(frameon=False)
 
     if folder != None:
-        plt.savefig(folder + '/' + label + '.eps')
+        plt.savefig(folder + '/' + label + '.pdf')
     else:
         plt.show()
 
 def video_all_nodes(features, graph, params, time, 
-                    outfile_name, framerate = 60):
+                    outfile_name, framerate = 60, dpi = 100):
     """
     Creates and saves a .mp4 video with pressure anf flow rate values for 
     all nodes in the graph.
@@ -160,76 +151,73 @@ def video_all_nodes(features, graph, params, time,
         time: duration of the video in seconds
         outfile_name (string): name of the output video
         framerate (int): framerate. Default -> 60
+        dpi (int): resolution of the frames. Default -> 100
 
     """
     nframes = time * framerate
 
-    indices = np.floor(np.linspace(0,features.shape[2]-1,nframes)).astype(int)
-
-    sel_pred_features = features[:,:,indices]
-    sel_real_features = graph.ndata['nfeatures'][:,:,indices]
-
-    sel_pred_features[:,0,:] = gng.invert_normalize(sel_pred_features[:,0,:],
-                                                   'pressure',
-                                                   params['statistics'],
-                                                   'features')
-    sel_pred_features[:,1,:] = gng.invert_normalize(sel_pred_features[:,1,:],
-                                                'flowrate',
-                                                params['statistics'],
-                                                'features')
-    sel_real_features[:,0,:] = gng.invert_normalize(sel_real_features[:,0,:],
-                                                   'pressure',
-                                                   params['statistics'],
-                                                   'features')
-    sel_real_features[:,1,:] = gng.invert_normalize(sel_real_features[:,1,:],
-                                                'flowrate',
-                                                params['statistics'],
-                                                'features')
-    minp = th.min(sel_real_features[:,0,:])
-    maxp = th.max(sel_real_features[:,0,:])
-    minq = th.min(sel_real_features[:,1,:])
-    maxq = th.max(sel_real_features[:,1,:])
-
-    fig, ax = plt.subplots(2, dpi = 284)
+    indices = np.linspace(0,features.shape[2]-1,nframes).astype(int)
+
+    # we convert to numpy only once: frames then index numpy arrays. Only
+    # pressure and flowrate are plotted, so predictions (index 0) and real
+    # values (index 1) are stacked and denormalized together
+    real_features = graph.ndata['nfeatures'][:,0:2,indices]
+    sel_features = np.stack((
+                    th.as_tensor(features[:,0:2,indices]).numpy(force = True),
+                    th.as_tensor(real_features).numpy(force = True)))
+    sel_features[:,:,0,:] = gng.invert_normalize(sel_features[:,:,0,:],
+                                                 'pressure',
+                                                 params['statistics'],
+                                                 'features')
+    sel_features[:,:,1,:] = gng.invert_normalize(sel_features[:,:,1,:],
+                                                 'flowrate',
+                                                 params['statistics'],
+                                                 'features')
+    sel_pred_features = sel_features[0]
+    sel_real_features = sel_features[1]
+
+    minp = np.min(sel_real_features[:,0,:])
+    maxp = np.max(sel_real_features[:,0,:])
+    minq = np.min(sel_real_features[:,1,:])
+    maxq = np.max(sel_real_features[:,1,:])
+
+    fig, ax = plt.subplots(2, dpi = dpi)
 
     nodes = np.arange(features.shape[0])
-    scatter_real_p = ax[0].scatter(nodes, sel_real_features[:,0,0], 
-                                   color = 'black', 
-                                   s = 1.5, alpha = 0.3)
-    scatter_pred_p = ax[0].scatter(nodes, sel_pred_features[:,0,0], 
-                                   color = 'red', s = 1.5, alpha = 1)
-    scatter_real_q = ax[1].scatter(nodes, sel_real_features[:,1,0], 
-                                   color = 'black', s = 1.5, alpha = 0.3)
-    scatter_pred_q = ax[1].scatter(nodes, sel_pred_features[:,1,0], 
-                                   color = 'red', s = 1.5, alpha = 1)
-    nodesidxs = np.expand_dims(nodes, axis = 1)
+    # node indices do not change: we use markers-only lines so that every
+    # frame only updates the y values
+    def plot_markers(axis, values, color, alpha):
+        return axis.plot(nodes, values, 'o', color = color, markersize = 1.2,
+                         markeredgewidth = 0, alpha = alpha)[0]
+
+    line_real_p = plot_markers(ax[0], sel_real_features[:,0,0], 'black', 0.3)
+    line_pred_p = plot_markers(ax[0], sel_pred_features[:,0,0], 'red', 1)
+    line_real_q = plot_markers(ax[1], sel_real_features[:,1,0], 'black', 0.3)
+    line_pred_q = plot_markers(ax[1], sel_pred_features[:,1,0], 'red', 1)
     ax[1].set_xlabel('graph node index')
     ax[0].set_ylabel('pressure [mmHg]')
     ax[1].set_ylabel('flowrate [cm^3/s]')
+    # limits do not change across frames
+    ax[0].set_xlim(0,features.shape[0])
+    ax[0].set_ylim((minp, maxp))
+    ax[1].set_xlim(0,features.shape[0])
+    ax[1].set_ylim((minq, maxq))
+
     def animation_frame(i):
-        p = sel_real_features[:,0,i]
-        p = np.concatenate((nodesidxs, np.expand_dims(p, axis = 1)),axis = 1)
-        scatter_real_p.set_offsets(p)
-        p = sel_pred_features[:,0,i]
-        p = np.concatenate((nodesidxs, np.expand_dims(p, axis = 1)),axis = 1)
-        scatter_pred_p.set_offsets(p)
-        q = sel_real_features[:,1,i]
-        q = np.concatenate((nodesidxs, np.expand_dims(q, axis = 1)),axis = 1)
-        scatter_real_q.set_offsets(q)
-        q = sel_pred_features[:,1,i]
-        q = np.concatenate((nodesidxs, np.expand_dims(q, axis = 1)),axis = 1)
-        scatter_pred_q.set_offsets(q)
+        line_real_p.set_ydata(sel_real_features[:,0,i])
+        line_pred_p.set_ydata(sel_pred_features[:,0,i])
+        line_real_q.set_ydata(sel_real_features[:,1,i])
+        line_pred_q.set_ydata(sel_pred_features[:,1,i])
 
         # ax[0].set_title('{:.2f} s'.format(float(times[i])))
-        ax[0].set_xlim(0,features.shape[0])
-        ax[0].set_ylim((minp, maxp))
-        ax[1].set_xlim(0,features.shape[0])
-        ax[1].set_ylim((minq, maxq))
  
-        return scatter_pred_p,
+        return line_real_p, line_pred_p, line_real_q, line_pred_q
     
     anim = animation.FuncAnimation(fig, animation_frame,
                                    frames=indices.size,
-                                   interval=20)
-    writervideo = animation.FFMpegWriter(fps=framerate)
+                                   interval=20, blit=True)
+    writervideo = animation.FFMpegWriter(fps=framerate, codec='libx264',
+                                         extra_args=['-pix_fmt', 'yuv420p',
+                                                     '-preset', 'ultrafast',
+                                                     '-crf', '23'])
     anim.save(outfile_name, writer = writervideo)